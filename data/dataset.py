@@ -134,7 +134,6 @@ class AgentFormerDataset(Dataset):
         """
         return batch[0]
         def pad_and_stack(batch):
-            import ipdb; ipdb.set_trace()
             max_shape_in_each_dim = torch.max(torch.stack([data.shape for data in batch]), axis=-1)
             # torch.zeros((len(batch), *max_shape_in_each_dim)).to(batch[0].device)
             batch = [torch.nn.functional.pad(data, tuple([dim - data.shape[dim_i] for dim_i, dim in enumerate(max_shape_in_each_dim)]), value=0.) for data in batch]
@@ -343,10 +342,8 @@ class AgentFormerDataset(Dataset):
                             value[index] = elem
                     try:
                         batch_dict[key] = torch.stack(value)
-                    except:
-                        import ipdb;
-                        ipdb.set_trace()
-                        a = 1
+                    except RuntimeError as e:
+                        raise RuntimeError(f'could not stack batch key {key}') from e
             return batch_dict
 
         def collate_batch(batch):
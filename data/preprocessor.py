@@ -1,6 +1,8 @@
 import torch, os, numpy as np, copy
+import pandas as pd
 import cv2
 import glob
+import tempfile
 from .map import GeometricMap
 
 
@@ -34,8 +36,12 @@ class preprocess(object):
         else:
             assert False, 'error'
 
-        self.gt = np.genfromtxt(label_path, delimiter=delimiter, dtype=str)
-        frames = self.gt[:, 0].astype(np.float32).astype(np.int)
+        self.class_names = {'Pedestrian': 1, 'Car': 2, 'Cyclist': 3, 'Truck': 4, 'Van': 5, 'Tram': 6, 'Person': 7, \
+            'Misc': 8, 'DontCare': 9, 'Traffic_cone': 10, 'Construction_vehicle': 11, 'Barrier': 12, 'Motorcycle': 13, \
+            'Bicycle': 14, 'Bus': 15, 'Trailer': 16, 'Emergency': 17, 'Construction': 18}
+        self.cache_gt = parser.get('cache_gt', True)
+        self.gt = self.load_gt(label_path, delimiter)
+        frames = self.gt[:, 0].astype(np.int)
         fr_start, fr_end = frames.min(), frames.max()
         self.init_frame = fr_start
         self.num_fr = fr_end + 1 - fr_start
@@ -45,14 +51,32 @@ class preprocess(object):
         else:
             self.geom_scene_map = None
 
-        self.class_names = class_names = {'Pedestrian': 1, 'Car': 2, 'Cyclist': 3, 'Truck': 4, 'Van': 5, 'Tram': 6, 'Person': 7, \
-            'Misc': 8, 'DontCare': 9, 'Traffic_cone': 10, 'Construction_vehicle': 11, 'Barrier': 12, 'Motorcycle': 13, \
-            'Bicycle': 14, 'Bus': 15, 'Trailer': 16, 'Emergency': 17, 'Construction': 18}
-        for row_index in range(len(self.gt)):
-            self.gt[row_index][2] = class_names[self.gt[row_index][2]]
-        self.gt = self.gt.astype('float32')
         self.xind, self.zind = 13, 15
 
+    def load_gt(self, label_path, delimiter):
+        """parse the label file into float32, caching the result as a .npy next to it.
+        the cache is keyed on the label file's exact size and mtime, so a restored older file is never served stale"""
+        stat = os.stat(label_path)
+        cache_path = f'{os.path.splitext(label_path)[0]}.{stat.st_size}-{stat.st_mtime_ns}.npy'
+        if self.cache_gt and os.path.exists(cache_path):
+            return np.load(cache_path)
+
+        gt = pd.read_csv(label_path, sep=delimiter, header=None, engine='c')
+        gt[2] = gt[2].map(self.class_names.__getitem__)    # class name -> class id
+        gt = gt.to_numpy(dtype=np.float32)
+        if self.cache_gt:
+            # write to a temp file and rename so concurrent ranks never read a partial cache
+            tmp_path = None
+            try:
+                fd, tmp_path = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(cache_path))
+                with os.fdopen(fd, 'wb') as f:
+                    np.save(f, gt)
+                os.replace(tmp_path, cache_path)
+            except OSError:    # e.g. read-only dataset dir; just use the parsed array
+                if tmp_path is not None and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return gt
+
     def GetID(self, data):
         id = []
         for i in range(data.shape[0]):
@@ -78,15 +102,21 @@ class preprocess(object):
             DataList.append(data)
         return DataList
 
+    def exist_in_frames(self, ids, frames):
+        """whether each id appears in every frame, with one np.isin per frame instead of a membership test per id"""
+        exist = np.ones(len(ids), dtype=bool)
+        for data in frames:
+            if isinstance(data, list):
+                exist[:] = False
+            else:
+                exist &= np.isin(ids, data[:, 1])
+        return exist
+
     def get_valid_id(self, pre_data, fut_data):
         cur_id = self.GetID(pre_data[0])
-        valid_id = []
-        for idx in cur_id:
-            exist_pre = [(False if isinstance(data, list) else (idx in data[:, 1])) for data in pre_data[:self.min_past_frames]]
-            exist_fut = [(False if isinstance(data, list) else (idx in data[:, 1])) for data in fut_data[:self.min_future_frames]]
-            if np.all(exist_pre) and np.all(exist_fut):
-                valid_id.append(idx)
-        return valid_id
+        exist = self.exist_in_frames(cur_id, pre_data[:self.min_past_frames]) & \
+                self.exist_in_frames(cur_id, fut_data[:self.min_future_frames])
+        return [idx for idx, exist_i in zip(cur_id, exist) if exist_i]
 
     def get_pred_mask(self, cur_data, valid_id):
         pred_mask = np.zeros(len(valid_id), dtype=np.int)
@@ -113,45 +143,44 @@ class preprocess(object):
         self.geom_scene_map = GeometricMap(self.scene_map, homography, self.map_origin)
         self.scene_vis_map = GeometricMap(self.scene_vis_map, homography, self.map_origin)
 
+    def get_rows(self, data, ids):
+        """row index of each id in data[:, 1] and whether it exists, using one sort instead of a mask per id"""
+        if len(data) == 0:
+            return np.zeros(len(ids), dtype=np.int64), np.zeros(len(ids), dtype=bool)
+        order = np.argsort(data[:, 1], kind='stable')
+        sorted_ids = data[order, 1]
+        pos = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+        return order[pos], sorted_ids[pos] == ids
+
     def PreMotion(self, DataTuple, valid_id):
-        motion = []
-        mask = []
-        for identity in valid_id:
-            mask_i = torch.zeros(self.past_frames)
-            box_3d = torch.zeros([self.past_frames, 2])
-            for j in range(self.past_frames):
-                past_data = DataTuple[j]              # past_data
-                if len(past_data) > 0 and identity in past_data[:, 1]:
-                    found_data = past_data[past_data[:, 1] == identity].squeeze()[[self.xind, self.zind]] / self.past_traj_scale
-                    box_3d[self.past_frames-1 - j, :] = torch.from_numpy(found_data).float()
-                    mask_i[self.past_frames-1 - j] = 1.0
-                elif j > 0:
-                    box_3d[self.past_frames-1 - j, :] = box_3d[self.past_frames - j, :]    # if none, copy from previous
-                else:
-                    raise ValueError('current id missing in the first frame!')
-            motion.append(box_3d)
-            mask.append(mask_i)
-        return motion, mask
+        motion = torch.zeros([len(valid_id), self.past_frames, 2])
+        mask = torch.zeros([len(valid_id), self.past_frames])
+        for j in range(self.past_frames):
+            past_data = DataTuple[j]              # past_data
+            rows, found = self.get_rows(past_data, valid_id)
+            if j == 0 and not np.all(found):
+                raise ValueError('current id missing in the first frame!')
+            found_data = past_data[rows[found]][:, [self.xind, self.zind]] / self.past_traj_scale
+            motion[found, self.past_frames-1 - j] = torch.from_numpy(found_data).float()
+            if j > 0:
+                motion[~found, self.past_frames-1 - j] = motion[~found, self.past_frames - j]    # if none, copy from previous
+            mask[found, self.past_frames-1 - j] = 1.0
+        return list(motion), list(mask)
 
     def FutureMotion(self, DataTuple, valid_id):
-        motion = []
-        mask = []
-        for identity in valid_id:
-            mask_i = torch.zeros(self.future_frames)
-            pos_3d = torch.zeros([self.future_frames, 2])
-            for j in range(self.future_frames):
-                fut_data = DataTuple[j]              # cur_data
-                if len(fut_data) > 0 and identity in fut_data[:, 1]:
-                    found_data = fut_data[fut_data[:, 1] == identity].squeeze()[[self.xind, self.zind]] / self.traj_scale
-                    pos_3d[j, :] = torch.from_numpy(found_data).float()
-                    mask_i[j] = 1.0
-                elif j > 0:
-                    pos_3d[j, :] = pos_3d[j - 1, :]    # if none, copy from previous
-                else:
-                    raise ValueError('current id missing in the first frame!')
-            motion.append(pos_3d)
-            mask.append(mask_i)
-        return motion, mask
+        motion = torch.zeros([len(valid_id), self.future_frames, 2])
+        mask = torch.zeros([len(valid_id), self.future_frames])
+        for j in range(self.future_frames):
+            fut_data = DataTuple[j]              # cur_data
+            rows, found = self.get_rows(fut_data, valid_id)
+            if j == 0 and not np.all(found):
+                raise ValueError('current id missing in the first frame!')
+            found_data = fut_data[rows[found]][:, [self.xind, self.zind]] / self.traj_scale
+            motion[found, j] = torch.from_numpy(found_data).float()
+            if j > 0:
+                motion[~found, j] = motion[~found, j - 1]    # if none, copy from previous
+            mask[found, j] = 1.0
+        return list(motion), list(mask)
 
     def __call__(self, frame):
 
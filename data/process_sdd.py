@@ -24,7 +24,9 @@ def get_data_split(dataset_path='./datasets/trajnet_split', mode='train'):
         data.append(gt)
 
     data = np.concatenate(data)
-    np.savetxt(os.path.join(dataset_path, f'{mode}.txt'), data, fmt="%s")
+    # same text as np.savetxt(fmt="%s"), joined in one pass and written with one write
+    with open(os.path.join(dataset_path, f'{mode}.txt'), 'w') as f:
+        f.write(''.join(' '.join(row) + '\n' for row in data.tolist()))
 
 
 if __name__ == '__main__':
@@ -1,6 +1,6 @@
 import numpy as np
 
-from metrics import stats_func
+from metrics import stats_func, compute_dist, check_any_collision_no_gt
 
 
 def eval_one_seq(agent_traj, gt_traj, collision_rad, return_sample_vals=False):
@@ -13,6 +13,7 @@ def eval_one_seq(agent_traj, gt_traj, collision_rad, return_sample_vals=False):
     all_sample_vals = {}
     argmins = None
     collision_mats = None
+    dist = compute_dist(agent_traj, gt_traj)  # shared by every ADE / FDE stat
     for stats_name in stats_func:
         func = stats_func[stats_name]
         return_sample_vals_this_stat = return_sample_vals if stats_name in ['ADE_joint', 'FDE_joint', 'CR_mean'] else False
@@ -21,7 +22,8 @@ def eval_one_seq(agent_traj, gt_traj, collision_rad, return_sample_vals=False):
         stats_func_args = {'pred_arr': agent_traj, 'gt_arr': gt_traj, 'collision_rad': collision_rad,
                            'return_sample_vals': return_sample_vals_this_stat,
                            'return_argmin': return_argmins_this_stat,
-                           'return_collision_mat': return_collision_mats_this_stat}
+                           'return_collision_mat': return_collision_mats_this_stat,
+                           'dist': dist}
         value = func(**stats_func_args)
         if return_sample_vals_this_stat:
             value, sample_vals = value
@@ -33,8 +35,63 @@ def eval_one_seq(agent_traj, gt_traj, collision_rad, return_sample_vals=False):
                 value, collision_mats = value
             else:
                 value, minADE_collision_mats = value
-                collision_mats.extend(minADE_collision_mats)
-                collision_mats = np.array(collision_mats)
+                collision_mats = np.concatenate([collision_mats, minADE_collision_mats])
         values.append(value)
 
     return values, all_sample_vals, argmins, collision_mats
+
+
+def eval_seqs(agent_trajs, gt_trajs, collision_rad, batch_size=32):
+    """stat values of eval_one_seq (without sample vals) for many sequences at once.
+    Sequences are sorted by number of peds and evaluated in batches padded to the largest of them.
+    Input:
+        - agent_trajs: list of (num_peds, samples, frames, 2)
+        - gt_trajs: list of (num_peds, frames, 2)
+    Return:
+        - values: (num_seqs, len(stats_func)), in the order of stats_func"""
+    num_peds = np.array([len(gt_traj) for gt_traj in gt_trajs])
+    values = np.zeros((len(gt_trajs), len(stats_func)))
+    order = np.argsort(num_peds, kind='stable')  # similar-sized sequences share a batch, so there is little padding
+    for start in range(0, len(order), batch_size):
+        seq_idx = order[start:start + batch_size]
+        values[seq_idx] = _eval_seq_batch([agent_trajs[i] for i in seq_idx], [gt_trajs[i] for i in seq_idx],
+                                          collision_rad)
+    return values
+
+
+def _eval_seq_batch(agent_trajs, gt_trajs, collision_rad):
+    """padded peds are NaN, so they never collide and are masked out of every mean over peds"""
+    num_peds = np.array([len(gt_traj) for gt_traj in gt_trajs])
+    n_seq, max_peds = len(gt_trajs), num_peds.max()
+    _, n_sample, n_frame, _ = agent_trajs[0].shape
+    pred_arr = np.full((n_seq, max_peds, n_sample, n_frame, 2), np.nan, dtype=agent_trajs[0].dtype)
+    gt_arr = np.full((n_seq, max_peds, n_frame, 2), np.nan, dtype=gt_trajs[0].dtype)
+    for seq_i, (agent_traj, gt_traj) in enumerate(zip(agent_trajs, gt_trajs)):
+        pred_arr[seq_i, :len(gt_traj)] = agent_traj
+        gt_arr[seq_i, :len(gt_traj)] = gt_traj
+    ped_mask = np.arange(max_peds) < num_peds[:, np.newaxis]  # (n_seq, max_peds)
+
+    def ped_mean(x):  # (n_seq, max_peds, ...) -> (n_seq, ...)
+        mask = ped_mask.reshape(ped_mask.shape + (1,) * (x.ndim - 2))
+        return np.where(mask, x, 0).sum(axis=1) / num_peds.reshape((-1,) + (1,) * (x.ndim - 2))
+
+    dist = compute_dist(pred_arr.reshape(-1, n_sample, n_frame, 2), gt_arr.reshape(-1, n_frame, 2))
+    dist = dist.reshape(n_seq, max_peds, n_sample, n_frame)
+    ades_per_sample = dist.mean(axis=-1)  # n_seq x max_peds x samples
+    fdes_per_sample = dist[..., -1]
+    ade_joint_per_sample = ped_mean(ades_per_sample)  # n_seq x samples
+    fde_joint_per_sample = ped_mean(fdes_per_sample)
+
+    # collisions of every sample, and of the sample with min joint ADE
+    samples = pred_arr.transpose(0, 2, 1, 3, 4).reshape(-1, max_peds, n_frame, 2)
+    cr_per_sample = check_any_collision_no_gt(samples, collision_rad).reshape(n_seq, n_sample, max_peds).sum(axis=-1)
+    min_ade_samples = pred_arr[np.arange(n_seq), :, ade_joint_per_sample.argmin(axis=-1)]
+    cr_min_ade = check_any_collision_no_gt(min_ade_samples, collision_rad).sum(axis=-1)
+
+    values = {'ADE_marginal': ped_mean(ades_per_sample.min(axis=-1)),
+              'FDE_marginal': ped_mean(fdes_per_sample.min(axis=-1)),
+              'CR_mean': cr_per_sample.mean(axis=-1) / num_peds,
+              'ADE_joint': ade_joint_per_sample.min(axis=-1),
+              'FDE_joint': fde_joint_per_sample.min(axis=-1),
+              'CR_mADEjoint': cr_min_ade / num_peds}
+    return np.stack([values[stats_name] for stats_name in stats_func], axis=-1)
@@ -1,13 +1,20 @@
 import numpy as np
-from scipy.spatial.distance import pdist, squareform, cdist
 from functools import partial
 
 
-def compute_ADE_joint(pred_arr, gt_arr, return_sample_vals=False, return_argmin=False, **kwargs):
-    pred_arr = np.array(pred_arr)
-    gt_arr = np.array(gt_arr)
-    diff = pred_arr - np.expand_dims(gt_arr, axis=1)  # num_peds x samples x frames x 2
-    dist = np.linalg.norm(diff, axis=-1)  # num_peds x samples x frames
+def compute_dist(pred_arr, gt_arr):
+    """displacement of each ped-sample-frame from the gt; computed once and shared by all ADE / FDE metrics.
+    Input:
+        - pred_arr: (num_peds, samples, frames, 2)
+        - gt_arr: (num_peds, frames, 2)
+    Return:
+        - dist: (num_peds, samples, frames)"""
+    diff = np.asarray(pred_arr) - np.expand_dims(np.asarray(gt_arr), axis=1)  # num_peds x samples x frames x 2
+    return np.sqrt(np.einsum('...i,...i->...', diff, diff))
+
+
+def compute_ADE_joint(pred_arr, gt_arr, return_sample_vals=False, return_argmin=False, dist=None, **kwargs):
+    dist = compute_dist(pred_arr, gt_arr) if dist is None else dist  # num_peds x samples x frames
     ade_per_sample = dist.mean(axis=-1).mean(axis=0)  # samples
     ade = ade_per_sample.min(axis=0)  # (1, )
     return_vals = [ade]
@@ -18,11 +25,8 @@ def compute_ADE_joint(pred_arr, gt_arr, return_sample_vals=False, return_argmin=
     return return_vals[0] if len(return_vals) == 1 else return_vals
 
 
-def compute_FDE_joint(pred_arr, gt_arr, return_sample_vals=False, return_argmin=False, **kwargs):
-    pred_arr = np.array(pred_arr)
-    gt_arr = np.array(gt_arr)
-    diff = pred_arr - np.expand_dims(gt_arr, axis=1)  # num_peds x samples x frames x 2
-    dist = np.linalg.norm(diff, axis=-1)  # num_peds x samples x frames
+def compute_FDE_joint(pred_arr, gt_arr, return_sample_vals=False, return_argmin=False, dist=None, **kwargs):
+    dist = compute_dist(pred_arr, gt_arr) if dist is None else dist  # num_peds x samples x frames
     fde_per_sample = dist[..., -1].mean(axis=0)  # samples
     fde = fde_per_sample.min(axis=0)  # (1, )
     return_vals = [fde]
@@ -34,13 +38,10 @@ def compute_FDE_joint(pred_arr, gt_arr, return_sample_vals=False, return_argmin=
 
 
 def compute_ADE_marginal(pred_arr, gt_arr, return_sample_vals=False, return_ped_vals=False,
-                         return_argmin=False, **kwargs):
+                         return_argmin=False, dist=None, **kwargs):
     """about 4 times faster due to numpy vectorization"""
     # assert pred_arr.shape[1] == 20, pred_arr.shape
-    pred_arr = np.array(pred_arr)
-    gt_arr = np.array(gt_arr)
-    diff = pred_arr - np.expand_dims(gt_arr, axis=1)  # num_peds x samples x frames x 2
-    dist = np.linalg.norm(diff, axis=-1)  # num_peds x samples x frames
+    dist = compute_dist(pred_arr, gt_arr) if dist is None else dist  # num_peds x samples x frames
     ades_per_sample = dist.mean(axis=-1)  # num_peds x samples
     made_per_ped = ades_per_sample.min(axis=-1)  # num_peds
     avg_made = made_per_ped.mean(axis=-1)  # (1,)
@@ -55,12 +56,9 @@ def compute_ADE_marginal(pred_arr, gt_arr, return_sample_vals=False, return_ped_
 
 
 def compute_FDE_marginal(pred_arr, gt_arr, return_sample_vals=False, return_ped_vals=False,
-                         return_argmin=False, **kwargs):
+                         return_argmin=False, dist=None, **kwargs):
     """about 4 times faster due to numpy vectorization"""
-    pred_arr = np.array(pred_arr)
-    gt_arr = np.array(gt_arr)
-    diff = pred_arr - np.expand_dims(gt_arr, axis=1)  # num_peds x samples x frames x 2
-    dist = np.linalg.norm(diff, axis=-1)  # num_peds x samples x frames
+    dist = compute_dist(pred_arr, gt_arr) if dist is None else dist  # num_peds x samples x frames
     fdes_per_sample = dist[..., -1]  # num_peds x samples
     mfde_per_ped = fdes_per_sample.min(axis=-1)  # num_peds
     avg_mfde = mfde_per_ped.mean(axis=-1)  # (1,)
@@ -78,72 +76,106 @@ def _lineseg_dist(a, b):
     """
     https://stackoverflow.com/questions/56463412/distance-from-a-point-to-a-line-segment-in-3d-python
     https://stackoverflow.com/questions/54442057/calculate-the-euclidian-distance-between-an-array-of-points-to-a-line-segment-in/54442561#54442561
+    distance from the origin to each segment a->b, specialized to 2D so each step is a single elementwise op
     """
-    # reduce computation
-    if np.all(a == b):
-        return np.linalg.norm(-a, axis=1)
+    ax, ay = a[:, 0], a[:, 1]
+    dx, dy = b[:, 0] - ax, b[:, 1] - ay
+    seg_len = np.hypot(dx, dy)
+    a_eq_b = seg_len == 0
 
     # normalized tangent vector
-    d = np.zeros_like(a)
-    # assert np.all(np.all(a == b, axis=-1) == np.isnan(ans))
-    a_eq_b = np.all(a == b, axis=-1)
-    d[~a_eq_b] = (b - a)[~a_eq_b] / np.linalg.norm(b[~a_eq_b] - a[~a_eq_b], axis=-1, keepdims=True)
+    dx = np.divide(dx, seg_len, out=np.zeros_like(dx), where=~a_eq_b)
+    dy = np.divide(dy, seg_len, out=np.zeros_like(dy), where=~a_eq_b)
 
     # signed parallel distance components
-    s = (a * d).sum(axis=-1)
-    t = (-b * d).sum(axis=-1)
+    s = ax * dx + ay * dy
+    t = -(b[:, 0] * dx + b[:, 1] * dy)
 
     # clamped parallel distance
-    h = np.maximum.reduce([s, t, np.zeros_like(t)], axis=0)
+    h = np.maximum(np.maximum(s, t), 0)
 
     # perpendicular distance component
-    c = np.cross(-a, d, axis=-1)
+    c = ay * dx - ax * dy
 
-    ans = np.hypot(h, np.abs(c))
+    ans = np.hypot(h, c)
 
     # edge case where agent stays still
-    ans[a_eq_b] = np.linalg.norm(-a, axis=1)[a_eq_b]
+    return np.where(a_eq_b, np.hypot(ax, ay), ans)
 
-    return ans
 
-
-def _get_diffs_pred(traj):
-    """Same order of ped pairs as pdist.
+def _candidate_collisions(pred_arr, ped_radius=0.1):
+    """broad + narrow phase collision test of every ped pair (in the same order as pdist), vectorized over samples.
     Input:
-        - traj: (ts, n_ped, 2)"""
-    num_peds = traj.shape[1]
-    return np.concatenate([np.tile(traj[:, ped_i:ped_i + 1], (1, num_peds - ped_i - 1, 1)) - traj[:, ped_i + 1:]
-                           for ped_i in range(num_peds)], axis=1)
-
+        - pred_arr: (n_samples, num_peds, ts, 2)
+    Return:
+        - shape: (n_samples, ts, num_peds)
+        - ped_i, ped_j: (n_ped_pairs,) the two peds of each pair
+        - sample_idx, pair_idx: (n_candidates,) the (sample, pair)s that passed the broad phase
+        - collision_t: (n_candidates, ts) whether each candidate collides at each timestep"""
+    # float32 is plenty for a ~0.1m collision radius and halves the memory traffic;
+    # cast and transpose in a single copy so the pair gathers below read contiguous rows
+    pred_arr = np.ascontiguousarray(np.asarray(pred_arr).transpose(0, 2, 1, 3), dtype=np.float32)  # (n_samples, ts, n_ped, 2)
+    n_samples, ts, num_peds, _ = pred_arr.shape
+    num_ped_pairs = (num_peds * (num_peds - 1)) // 2
+    ped_i, ped_j = np.triu_indices(num_peds, k=1)
+
+    # broad phase: a pair can only collide if the bounding boxes of their trajectories come within 2 radii
+    if num_peds > 4:
+        box_min = pred_arr.min(axis=1)  # (n_samples, n_ped, 2)
+        box_max = pred_arr.max(axis=1)
+        box_gap = np.maximum(box_min[:, ped_j] - box_max[:, ped_i], box_min[:, ped_i] - box_max[:, ped_j]).max(axis=-1)
+        candidates = box_gap < ped_radius * 2  # (n_samples, n_ped_pairs)
+    else:  # too few pairs for pruning to pay off
+        candidates = np.ones((n_samples, num_ped_pairs), dtype=bool)
+    sample_idx, pair_idx = np.nonzero(candidates)
+
+    # narrow phase: difference between each candidate pair. (n_candidates, ts, 2)
+    ped_pair_diffs_pred = pred_arr[sample_idx, :, ped_i[pair_idx]] - pred_arr[sample_idx, :, ped_j[pair_idx]]
+    collision_0_pred = np.linalg.norm(ped_pair_diffs_pred[:, 0], axis=-1) < ped_radius * 2
+    pxy = ped_pair_diffs_pred[:, :-1].reshape(-1, 2)
+    exy = ped_pair_diffs_pred[:, 1:].reshape(-1, 2)
+    collision_t_pred = _lineseg_dist(pxy, exy).reshape(len(pair_idx), ts - 1) < ped_radius * 2
+    collision_t = np.concatenate([collision_0_pred[:, np.newaxis], collision_t_pred], axis=1)
+
+    return (n_samples, ts, num_peds), ped_i, ped_j, sample_idx, pair_idx, collision_t
+
+
+def check_collision_no_gt(pred_arr, ped_radius=0.1):
+    """vectorized over samples; ped pairs in the same order as pdist.
+    Input:
+        - pred_arr: (n_samples, num_peds, ts, 2)
+    Return:
+        - n_ped_with_col_pred: (n_samples, num_peds)
+        - collision_mat_pred_t_bool: (n_samples, ts, num_peds, num_peds)"""
+    (n_samples, ts, num_peds), ped_i, ped_j, sample_idx, pair_idx, collision_t = \
+        _candidate_collisions(pred_arr, ped_radius)
+    collision_pairs_t = np.zeros((n_samples, ts, len(ped_i)), dtype=bool)
+    collision_pairs_t[sample_idx, :, pair_idx] = collision_t
 
-def _get_diffs_gt(traj, gt_traj):
-    """same order of ped pairs as pdist"""
-    num_peds = traj.shape[1]
-    return np.stack([
-            np.tile(traj[:, ped_i:ped_i + 1], (1, num_peds, 1)) - gt_traj
-            for ped_i in range(num_peds)
-    ],
-            axis=1)
+    collision_mat_pred_t_bool = np.zeros((n_samples, ts, num_peds, num_peds), dtype=bool)
+    collision_mat_pred_t_bool[..., ped_i, ped_j] = collision_pairs_t
+    collision_mat_pred_t_bool[..., ped_j, ped_i] = collision_pairs_t
+    n_ped_with_col_pred = np.any(collision_mat_pred_t_bool, axis=(1, 2))
 
+    return n_ped_with_col_pred, collision_mat_pred_t_bool
 
-def check_collision_per_sample_no_gt(sample, ped_radius=0.1):
-    """sample: (num_peds, ts, 2)"""
 
-    sample = sample.transpose(1, 0, 2)  # (ts, n_ped, 2)
-    ts, num_peds, _ = sample.shape
-    num_ped_pairs = (num_peds * (num_peds - 1)) // 2
+def check_any_collision_no_gt(pred_arr, ped_radius=0.1):
+    """same as check_collision_no_gt, but only whether each ped collides at all, without the per-timestep matrices.
+    Input:
+        - pred_arr: (n_samples, num_peds, ts, 2)
+    Return:
+        - n_ped_with_col_pred: (n_samples, num_peds)"""
+    (n_samples, ts, num_peds), ped_i, ped_j, sample_idx, pair_idx, collision_t = \
+        _candidate_collisions(pred_arr, ped_radius)
+    collision_pairs = np.zeros((n_samples, len(ped_i)), dtype=bool)
+    collision_pairs[sample_idx, pair_idx] = collision_t.any(axis=-1)
 
-    collision_0_pred = pdist(sample[0]) < ped_radius * 2
-    # Get difference between each pair. (ts, n_ped_pairs, 2)
-    ped_pair_diffs_pred = _get_diffs_pred(sample)
-    pxy = ped_pair_diffs_pred[:-1].reshape(-1, 2)
-    exy = ped_pair_diffs_pred[1:].reshape(-1, 2)
-    collision_t_pred = _lineseg_dist(pxy, exy).reshape(ts - 1, num_ped_pairs) < ped_radius * 2
-    collision_mat_pred_t_bool = np.stack([squareform(cm) for cm in np.concatenate([collision_0_pred[np.newaxis,...], collision_t_pred])])
-    collision_mat_pred = squareform(np.any(collision_t_pred, axis=0) | collision_0_pred)
-    n_ped_with_col_pred_per_sample = np.any(collision_mat_pred, axis=0)
+    collision_mat = np.zeros((n_samples, num_peds, num_peds), dtype=bool)
+    collision_mat[:, ped_i, ped_j] = collision_pairs
+    collision_mat[:, ped_j, ped_i] = collision_pairs
 
-    return n_ped_with_col_pred_per_sample, collision_mat_pred_t_bool
+    return collision_mat.any(axis=1)
 
 
 def compute_CR(pred_arr,
@@ -153,12 +185,14 @@ def compute_CR(pred_arr,
                return_collision_mat=False,
                collision_rad=None,
                k2=False,
+               dist=None,
                **kwargs):
     """Compute collision rate and collision-free likelihood.
     Input:
         - pred_arr: (np.array) (n_pedestrian, n_samples, timesteps, 4)
         - gt_arr: (np.array) (n_pedestrian, timesteps, 4)
         - k2: if True, computes the proportion of K^2 agent-pairs that collide.
+        - dist: (optional) precomputed compute_dist(pred_arr, gt_arr), passed on to a callable aggregation
     Return:
         Collision rates
     """
@@ -166,7 +200,7 @@ def compute_CR(pred_arr,
 
     # if evaluating different indices
     if callable(aggregation):  # aggregation can be marginal ADE or FDE
-        indices = aggregation(pred_arr, gt_arr, return_argmin=True)[-1]
+        indices = aggregation(pred_arr, gt_arr, return_argmin=True, dist=dist)[-1]
         n_sample = 1
         if indices.shape[0] == 1:
             pred_arr = pred_arr[:, indices]
@@ -177,18 +211,20 @@ def compute_CR(pred_arr,
             raise RuntimeError(f'indices is wrong shape: is {indices.shape} but should be (1,) or ({n_ped},)')
         assert len(pred_arr.shape) == 4
 
-    pred_arr = np.array(pred_arr).swapaxes(1, 0)
+    pred_arr = np.asarray(pred_arr).swapaxes(1, 0)  # view; check_collision_no_gt makes the one contiguous copy
     # (n_agents, n_samples, timesteps, 4) > (n_samples, n_agents, timesteps 4)
-    col_pred = np.zeros((n_sample))
-    col_mats = []
-    for sample_idx, pa in enumerate(pred_arr):
-        if k2:
+    if k2:
+        col_pred = np.zeros((n_sample))
+        col_mats = []
+        for sample_idx, pa in enumerate(pred_arr):
             n_ped_with_col_pred, col_mat = check_collision_per_sample_k2(pa, collision_rad)
             col_pred[sample_idx] += n_ped_with_col_pred.sum()
-        else:
-            n_ped_with_col_pred, col_mat = check_collision_per_sample_no_gt(pa, collision_rad)
-            col_pred[sample_idx] += n_ped_with_col_pred.sum()
-        col_mats.append(col_mat)
+            col_mats.append(col_mat)
+    elif return_collision_mat:  # all samples at once
+        n_ped_with_col_pred, col_mats = check_collision_no_gt(pred_arr, collision_rad)
+        col_pred = n_ped_with_col_pred.sum(axis=-1)
+    else:  # no need to build the per-timestep collision matrices
+        col_pred = check_any_collision_no_gt(pred_arr, collision_rad).sum(axis=-1)
 
     if aggregation == 'mean':
         cr_pred = col_pred.mean(axis=0)
@@ -1,6 +1,5 @@
 import torch
 from torch import nn
-from torch.nn import functional as F
 from collections import defaultdict
 
 from .common.mlp import MLP
@@ -563,8 +562,8 @@ class AgentFormer(nn.Module):
         self.context_encoder = ContextEncoder(cfg.context_encoder, self.ctx)
         self.future_encoder = FutureEncoder(cfg.future_encoder, self.ctx)
         if self.ctx['sfm_params'].get('learnable_hparams', False):
-            print("SHOULDNT BE HEREn\n\n\n\n")
-            import ipdb; ipdb.set_trace()
+            if self.use_sfm:  # set_data's sfm features need compute_grad_feature, which this tree doesn't have
+                raise NotImplementedError('sfm learnable_hparams is not supported')
             self.recon_weight = nn.Parameter(torch.ones(1) * 5)#torch.rand(1) * 10)
             self.sample_weight = nn.Parameter(torch.ones(1) * 5) # torch.rand(1) * 10)
             self.sigma_d = nn.Parameter(torch.zeros(1))#torch.ones(1))
@@ -584,7 +583,7 @@ class AgentFormer(nn.Module):
         device = self.device
         for k, v in data.items():
             if 'motion' in k:
-                data[k] = [torch.tensor(a).to(device) for a in data[k]]
+                data[k] = [torch.tensor(a, device=device) for a in data[k]]
         return data
 
     def set_data(self, data):
@@ -602,8 +601,8 @@ class AgentFormer(nn.Module):
         self.data['batch_size'] = len(in_data['pre_motion_3D'])
         self.data['agent_num'] = len(in_data['pre_motion_3D'])
         self.data['pre_motion'] = torch.stack(in_data['pre_motion_3D'], dim=0).to(device).transpose(0, 1).contiguous()
-        self.data['fut_motion'] = torch.stack(in_data['fut_motion_3D'], dim=0).to(device).transpose(0, 1).contiguous()
         self.data['fut_motion_orig'] = torch.stack(in_data['fut_motion_3D'], dim=0).to(device)   # future motion without transpose
+        self.data['fut_motion'] = self.data['fut_motion_orig'].transpose(0, 1).contiguous()
         self.data['fut_mask'] = torch.stack(in_data['fut_motion_mask'], dim=0).to(device)
         self.data['pre_mask'] = torch.stack(in_data['pre_motion_mask'], dim=0).to(device)
         scene_orig_all_past = self.cfg.get('scene_orig_all_past', False)
@@ -612,7 +611,7 @@ class AgentFormer(nn.Module):
         else:
             self.data['scene_orig'] = self.data['pre_motion'][-1].mean(dim=0)
         if in_data['heading'] is not None:
-            self.data['heading'] = torch.tensor(in_data['heading']).float().to(device)
+            self.data['heading'] = torch.tensor(in_data['heading'], dtype=torch.float32, device=device)
 
         # rotate the scene
         if self.rand_rot_scene and self.training:
@@ -625,7 +624,7 @@ class AgentFormer(nn.Module):
             if in_data['heading'] is not None:
                 self.data['heading'] += theta
         else:
-            theta = torch.zeros(1).to(device)
+            theta = torch.zeros(1, device=device)
             for key in ['pre_motion', 'fut_motion', 'fut_motion_orig']:
                 self.data[f'{key}_scene_norm'] = self.data[key] - self.data['scene_orig']   # normalize per scene
 
@@ -659,14 +658,11 @@ class AgentFormer(nn.Module):
         cur_motion = self.data['cur_motion'][0]
         if conn_dist < 1000.0:
             threshold = conn_dist / self.cfg.traj_scale
-            pdist = F.pdist(cur_motion)
-            D = torch.zeros([cur_motion.shape[0], cur_motion.shape[0]]).to(device)
-            D[np.triu_indices(cur_motion.shape[0], 1)] = pdist
-            D = D + D.T
+            D = torch.cdist(cur_motion, cur_motion, compute_mode='donot_use_mm_for_euclid_dist')
             mask = torch.zeros_like(D)
             mask[D > threshold] = float('-inf')
         else:
-            mask = torch.zeros([cur_motion.shape[0], cur_motion.shape[0]]).to(device)
+            mask = torch.zeros([cur_motion.shape[0], cur_motion.shape[0]], device=device)
         self.data['agent_mask'] = mask
 
         # social force features
@@ -7,14 +7,18 @@ import torch
 import pytorch_lightning as pl
 
 from model.model_lib import model_dict
-from eval import eval_one_seq
+from eval import eval_one_seq, eval_seqs
 from metrics import stats_func
 from utils.utils import mkdir_if_missing
 from utils.torch import get_scheduler
-from viz_utils import plot_anim_grid, get_metrics_str
+from visualization_utils import plot_anim_grid, get_metrics_str
 
+ETH_UCY_DATASETS = frozenset(['eth', 'hotel', 'univ', 'zara1', 'zara2'])
+# datasets whose label files store the 2D position in columns [13, 15]
+POS_13_15_DATASETS = ETH_UCY_DATASETS | {'gen', 'real_gen', 'adversarial'}
 
-def save_trajectories(trajectory, save_dir, seq_name, frame, suffix=''):
+
+def save_trajectories(trajectory, save_dir, seq_name, frame, suffix='', mkdir=True):
     """Save trajectories in a text file.
     Input:
         trajectory: (np.array/torch.Tensor) Predcited trajectories with shape
@@ -24,57 +28,114 @@ def save_trajectories(trajectory, save_dir, seq_name, frame, suffix=''):
         seq_name: (str) Sequence name (e.g., eth_biwi, coupa_0)
         frame: (num) Frame ID.
         suffix: (str) Additional suffix to put into file name.
+        mkdir: (bool) Create the file's directory if missing; False if the caller already did.
     """
     fname = f"{save_dir}/{seq_name}/frame_{int(frame):06d}{suffix}.txt"
-    mkdir_if_missing(fname)
+    if mkdir:
+        mkdir_if_missing(fname)
 
     if isinstance(trajectory, torch.Tensor):
         trajectory = trajectory.cpu().numpy()
-    np.savetxt(fname, trajectory, fmt="%.3f")
+    if trajectory.ndim == 1:  # np.savetxt writes 1-D input as a column
+        trajectory = trajectory[:, np.newaxis]
+    # same text as np.savetxt(fmt="%.3f"), but formatted with one string op and written with one write
+    row_fmt = ' '.join(['%.3f'] * trajectory.shape[1]) + '\n'
+    with open(fname, 'w') as f:
+        f.write((row_fmt * trajectory.shape[0]) % tuple(trajectory.ravel().tolist()))
 
 
 def format_agentformer_trajectories(trajectory, data, cfg, timesteps=12, frame_scale=10, future=True):
-    formatted_trajectories = []
+    """trajectory: (n_agent, timesteps, 2), or (n_samples, n_agent, timesteps, 2) to format all samples at once,
+    which gives (n_samples, rows, cols). the row lookup of the agents is shared by all samples"""
+    if isinstance(trajectory, torch.Tensor):  # one device-to-host copy for the whole trajectory
+        trajectory = trajectory.cpu().numpy()
     if not future:
-        trajectory = torch.flip(trajectory, [0, 1])
-    for i, track_id in enumerate(data['valid_id']):
-        if data['pred_mask'] is not None and data['pred_mask'][i] != 1.0:
-            continue
-        for j in range(timesteps):
-            if future:
-                curr_data = data['fut_data'][j]
-            else:
-                curr_data = data['pre_data'][j]
-            # Get data with the same track_id
-            updated_data = curr_data[curr_data[:, 1] == track_id].squeeze()
-            if cfg.dataset in [
-                    'eth', 'hotel', 'univ', 'zara1', 'zara2', 'gen',
-                    'real_gen', 'adversarial'
-            ]:
-                # [13, 15] correspoinds to the 2D position
-                updated_data[[13, 15]] = trajectory[i, j].cpu().numpy()
-            elif 'sdd' in cfg.dataset:
-                updated_data[[2, 3]] = trajectory[i, j].cpu().numpy()
-            else:
-                raise NotImplementedError()
-            formatted_trajectories.append(updated_data)
-    if len(formatted_trajectories) == 0:
-        return np.array([])
-
-    # Convert to numpy array and get [frame_id, track_id, x, y]
-    formatted_trajectories = np.vstack(formatted_trajectories)
-    if cfg.dataset in [ 'eth', 'hotel', 'univ', 'zara1', 'zara2' ]:
-        formatted_trajectories = formatted_trajectories[:, [0, 1, 13, 15]]
-        formatted_trajectories[:, 0] *= frame_scale
+        trajectory = trajectory[..., ::-1, ::-1, :]
+    lead_shape = trajectory.shape[:-3]
+    if cfg.dataset in POS_13_15_DATASETS:
+        # [13, 15] correspoinds to the 2D position
+        pos_cols = [13, 15]
+    elif 'sdd' in cfg.dataset:
+        pos_cols = [2, 3]
+    else:
+        raise NotImplementedError()
+
+    if data['pred_mask'] is not None:
+        agent_mask = np.asarray(data['pred_mask']) == 1.0
+    else:
+        agent_mask = np.ones(len(data['valid_id']), dtype=bool)
+    track_ids = np.asarray(data['valid_id'])[agent_mask]
+    if len(track_ids) == 0:
+        return np.zeros(lead_shape + (0,))
+
+    frame_data = data['fut_data'] if future else data['pre_data']
+    formatted_trajectories = np.empty((len(track_ids), timesteps, frame_data[0].shape[1]), dtype=frame_data[0].dtype)
+    for j in range(timesteps):
+        curr_data = frame_data[j]
+        # Get data with the same track_id: one row lookup per agent instead of a mask over the frame per agent
+        id_to_row = {track_id: row for row, track_id in enumerate(curr_data[:, 1])}
+        rows = np.fromiter((id_to_row[track_id] for track_id in track_ids), dtype=np.int64, count=len(track_ids))
+        formatted_trajectories[:, j] = curr_data[rows]
+    formatted_trajectories = np.broadcast_to(formatted_trajectories, lead_shape + formatted_trajectories.shape).copy()
+    formatted_trajectories[..., pos_cols] = trajectory[..., agent_mask, :timesteps, :]
+
+    # agent-major rows, as (n_agent * timesteps, n_cols)
+    formatted_trajectories = formatted_trajectories.reshape(lead_shape + (-1, formatted_trajectories.shape[-1]))
+    # get [frame_id, track_id, x, y]
+    if cfg.dataset in ETH_UCY_DATASETS:
+        formatted_trajectories = formatted_trajectories[..., [0, 1, 13, 15]]
+        formatted_trajectories[..., 0] *= frame_scale
     elif cfg.dataset == 'trajnet_sdd':
-        formatted_trajectories[:, 0] *= frame_scale
+        formatted_trajectories[..., 0] *= frame_scale
 
     if not future:
-        formatted_trajectories = np.flip(formatted_trajectories, axis=0)
+        formatted_trajectories = np.flip(formatted_trajectories, axis=-2)
 
     return formatted_trajectories
 
 
+def plot_seq(seq_viz_args, model_name, dataset_name, epoch, tag=''):
+    """assemble the plot args of one sequence and render its animation grid"""
+    frame = seq_viz_args['frame']
+    seq = seq_viz_args['seq']
+    seq_to_sample_metrics = seq_viz_args['sample_vals']
+    collision_mats = seq_viz_args['collision_mats']
+    obs_traj = seq_viz_args['obs_traj']
+    assert obs_traj.shape[0] == 8
+    pred_gt_traj = seq_viz_args['gt_traj'].swapaxes(0, 1)
+    pred_fake_traj = seq_viz_args['pred_traj'].transpose(1, 2, 0, 3)  # (samples, ts, n_peds, 2)
+
+    num_samples, _, n_ped, _ = pred_fake_traj.shape
+
+    anim_save_fn = f'viz/{seq}/frame_{frame:06d}/{model_name}_epoch-{epoch}_{tag}.mp4'
+    mkdir_if_missing(anim_save_fn)
+    plot_args_list = [anim_save_fn, f"Seq: {seq} frame: {frame} Epoch: {epoch}", (5, 4)]
+
+    if dataset_name == 'trajnet_sdd':
+        bkg_img_path = os.path.join(f'datasets/trajnet_sdd/reference_img/{seq[:-2]}/video{seq[-1]}/reference.jpg')
+    else:
+        bkg_img_path = None
+    SADE_min_i = seq_viz_args['SADE_min_i']
+    pred_fake_traj_min = pred_fake_traj[SADE_min_i]
+    min_SADE_stats = get_metrics_str(seq_to_sample_metrics, SADE_min_i)
+    # args shared by every subplot of the grid, built once
+    common_args = {'obs_traj': obs_traj, 'pred_traj_gt': pred_gt_traj, 'bkg_img_path': bkg_img_path}
+    plot_args_list.append({**common_args,
+                           'plot_title': f"best mSADE sample",
+                           'pred_traj_fake': pred_fake_traj_min,
+                           'collision_mats': collision_mats[-1],
+                           'text_fixed': min_SADE_stats})
+
+    sample_args = {**common_args, 'highlight_peds': seq_viz_args['argmins']}
+    plot_args_list.extend({**sample_args,
+                           'plot_title': f"Sample {sample_i}",
+                           'pred_traj_fake': pred_fake_traj[sample_i],
+                           'text_fixed': get_metrics_str(seq_to_sample_metrics, sample_i),
+                           'collision_mats': collision_mats[sample_i]}
+                          for sample_i in range(num_samples - 1))
+    plot_anim_grid(*plot_args_list)
+
+
 class AgentFormerTrainer(pl.LightningModule):
     def __init__(self, cfg, args):
         super().__init__()
@@ -90,15 +151,37 @@ class AgentFormerTrainer(pl.LightningModule):
         self.hparams.update(vars(args))
         self.model_name = "_".join(self.cfg.id.split("_")[1:])
         self.dataset_name = self.cfg.id.split("_")[0].replace('-', '_')
+        if self.dataset_name == 'trajnet_sdd':
+            self.traj_save_dir = f'../trajectory_reward/results/trajectories/{self.model_name}/trajnet_sdd'
+        else:
+            self.traj_save_dir = f'../trajectory_reward/results/trajectories/{self.model_name}'
+        self._pool = None
 
     def update_args(self, args):
         self.args = args
 
+    def _get_pool(self):
+        """worker pool shared by metrics and viz across epochs, so workers are only started once.
+        forkserver children start from a clean server process instead of a fork of the (CUDA-initialized) trainer"""
+        if self._pool is None:
+            self._pool = multiprocessing.get_context('forkserver').Pool(self.num_workers, maxtasksperchild=64)
+        return self._pool
+
+    def teardown(self, stage=None):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
     def on_test_start(self):
         self.model.set_device(self.device)
+        if self.args.mp and self.args.save_viz:  # the pool only serves the viz path
+            self._get_pool()
 
     def on_fit_start(self):
         self.model.set_device(self.device)
+        if self.args.mp and self.args.save_viz:  # the pool only serves the viz path
+            self._get_pool()
 
     def _step(self, batch, mode):
         self.model.set_data(batch)
@@ -110,11 +193,17 @@ class AgentFormerTrainer(pl.LightningModule):
         for loss_name, loss in loss_dict.items():
             self.log(f'{mode}/{loss_name}', loss, on_step=False, on_epoch=True, sync_dist=True, logger=True, batch_size=self.batch_size)
 
-        gt_motion = self.cfg.traj_scale * data['fut_motion'].transpose(1, 0).cpu()
-        pred_motion = self.cfg.traj_scale * data[f'infer_dec_motion'].detach().cpu()
-        obs_motion = self.cfg.traj_scale * data[f'pre_motion'].cpu()  # .transpose(1, 0).cpu()
+        # plain numpy from here on: cheaper to keep around until epoch end and to pickle to the workers.
+        motions = [data['fut_motion'].transpose(1, 0), data[f'infer_dec_motion'].detach(), data[f'pre_motion']]
+        if motions[0].is_cuda:  # pack the three motions on the device so they come back in one device-to-host copy
+            packed = self.cfg.traj_scale * torch.cat([motion.reshape(-1) for motion in motions]).cpu().numpy()
+            split_at = np.cumsum([motion.numel() for motion in motions])[:-1]
+            gt_motion, pred_motion, obs_motion = [chunk.reshape(motion.shape)
+                                                  for chunk, motion in zip(np.split(packed, split_at), motions)]
+        else:  # already on the host; packing would only add a copy
+            gt_motion, pred_motion, obs_motion = [self.cfg.traj_scale * motion.numpy() for motion in motions]
         return {'loss': total_loss, **loss_dict, 'frame': batch['frame'], 'seq': batch['seq'],
-                'gt_motion': gt_motion, 'pred_motion': pred_motion, 'obs_motion': obs_motion, 'data': data}
+                'gt_motion': gt_motion, 'pred_motion': pred_motion, 'obs_motion': obs_motion}
 
     def training_step(self, batch, batch_idx):
         if self.args.tqdm_rate == 0 and batch_idx % 5 == 0:
@@ -131,114 +220,85 @@ class AgentFormerTrainer(pl.LightningModule):
         obs_motion = return_dict['obs_motion']
 
         if self.args.save_traj:
-            if self.dataset_name == 'trajnet_sdd':
-                save_dir = f'../trajectory_reward/results/trajectories/{self.model_name}/trajnet_sdd'
-            else:
-                save_dir = f'../trajectory_reward/results/trajectories/{self.model_name}'
+            save_dir = self.traj_save_dir
             frame = batch['frame'] * batch['frame_scale']
-            for idx, sample in enumerate(pred_motion.transpose(0, 1)):
-                formatted = format_agentformer_trajectories(sample, batch, self.cfg, timesteps=12,
-                                                            frame_scale=batch['frame_scale'], future=True)
-                save_trajectories(formatted, save_dir, batch['seq'], frame, suffix=f"/sample_{idx:03d}")
+            # every file of this frame goes in the same directory, so create it once
+            mkdir_if_missing(f"{save_dir}/{batch['seq']}/frame_{int(frame):06d}/")
+            formatted = format_agentformer_trajectories(pred_motion.swapaxes(0, 1), batch, self.cfg, timesteps=12,
+                                                        frame_scale=batch['frame_scale'], future=True)
+            for idx, sample in enumerate(formatted):
+                save_trajectories(sample, save_dir, batch['seq'], frame, suffix=f"/sample_{idx:03d}", mkdir=False)
             formatted = format_agentformer_trajectories(gt_motion, batch, self.cfg, timesteps=12,
                                                         frame_scale=batch['frame_scale'], future=True)
-            save_trajectories(formatted, save_dir, batch['seq'], frame, suffix='/gt')
-            formatted = format_agentformer_trajectories(obs_motion.transpose(0, 1), batch, self.cfg, timesteps=8,
+            save_trajectories(formatted, save_dir, batch['seq'], frame, suffix='/gt', mkdir=False)
+            formatted = format_agentformer_trajectories(obs_motion.swapaxes(0, 1), batch, self.cfg, timesteps=8,
                                                         frame_scale=batch['frame_scale'], future=False)
-            save_trajectories(formatted, save_dir, batch['seq'], frame, suffix="/obs")
+            save_trajectories(formatted, save_dir, batch['seq'], frame, suffix="/obs", mkdir=False)
 
         return return_dict
 
     def _epoch_end(self, outputs, mode='test'):
-        args_list = [(output['pred_motion'].numpy(), output['gt_motion'].numpy()) for output in outputs]
+        args_list = [(output['pred_motion'], output['gt_motion']) for output in outputs]
 
         # calculate metrics for each sequence
-        if self.args.mp:
-            with multiprocessing.Pool(self.num_workers) as pool:
-                all_metrics = pool.starmap(partial(eval_one_seq,
-                                                   collision_rad=self.collision_rad,
-                                                   return_sample_vals=self.args.save_viz), args_list)
-        else:
-            all_metrics = starmap(partial(eval_one_seq,
-                                          collision_rad=self.collision_rad,
-                                          return_sample_vals=self.args.save_viz), args_list)
-        all_metrics, all_sample_vals, argmins, collision_mats = zip(*all_metrics)
+        if self.args.save_viz:  # one sequence at a time, to also get the per-sample values for plotting
+            if self.args.mp:
+                # a few chunks per worker, rather than one task (and one round of pickling) per sequence
+                chunksize = max(1, len(args_list) // (4 * self.num_workers))
+                all_metrics = self._get_pool().starmap(partial(eval_one_seq,
+                                                               collision_rad=self.collision_rad,
+                                                               return_sample_vals=True), args_list, chunksize)
+            else:
+                all_metrics = starmap(partial(eval_one_seq,
+                                              collision_rad=self.collision_rad,
+                                              return_sample_vals=True), args_list)
+            all_metrics, all_sample_vals, argmins, collision_mats = zip(*all_metrics)
+        else:  # all sequences in padded batches
+            all_metrics = eval_seqs(*zip(*args_list), collision_rad=self.collision_rad)
 
         # aggregate metrics across sequences
         num_agent_per_seq = np.array([output['gt_motion'].shape[0] for output in outputs])
         total_num_agents = np.sum(num_agent_per_seq)
-        results_dict = {}
-        for key, values in zip(stats_func.keys(), zip(*all_metrics)):
-            if '_joint' in key or 'CR' in key:  # sequence-based metric
-                value = np.mean(values)
-            else:  # agent-based metric
-                value = np.sum(values * num_agent_per_seq) / np.sum(num_agent_per_seq)
-            results_dict[key] = value
+        metrics_arr = np.asarray(all_metrics, dtype=np.float64)  # (num_seqs, num_stats)
+        is_seq_metric = np.array(['_joint' in key or 'CR' in key for key in stats_func.keys()])
+        seq_vals = metrics_arr.mean(axis=0)  # sequence-based metric
+        agent_vals = num_agent_per_seq @ metrics_arr / total_num_agents  # agent-based metric
+        results_dict = dict(zip(stats_func.keys(), np.where(is_seq_metric, seq_vals, agent_vals)))
 
         # get stats related to collision_rejection sampling
         is_test_mode = mode == 'test'
 
         # print results to console for easy copy-and-paste
         if is_test_mode:
-            print(f"\n\n\n{self.current_epoch}")
-            for key, value in results_dict.items():
-                print(f"{value:.4f}")
-            print(total_num_agents)
+            lines = [f"\n\n\n{self.current_epoch}", *(f"{value:.4f}" for value in results_dict.values()), f"{total_num_agents}"]
+            print("\n".join(lines))
 
         # log metrics to tensorboard
         for key, value in results_dict.items():
             self.log(f'{mode}/{key}', value, sync_dist=True, prog_bar=True, logger=True)
 
     def _save_viz(self, outputs, all_sample_vals, all_meters_values, argmins, collision_mats, tag=''):
-        seq_to_plot_args = []
-        for frame_i, (output, seq_to_sample_metrics) in enumerate(zip(outputs, all_sample_vals)):
-            frame = output['frame']
-            seq = output['seq']
-            obs_traj = output['obs_motion'].numpy()
-            assert obs_traj.shape[0] == 8
-            pred_gt_traj = output['gt_motion'].numpy().swapaxes(0, 1)
-            pred_fake_traj = output['pred_motion'].numpy().transpose(1, 2, 0, 3)  # (samples, ts, n_peds, 2)
-
-            num_samples, _, n_ped, _ = pred_fake_traj.shape
-
-            anim_save_fn = f'viz/{seq}/frame_{frame:06d}/{self.model_name}_epoch-{self.current_epoch}_{tag}.mp4'
-            mkdir_if_missing(anim_save_fn)
-            plot_args_list = [anim_save_fn, f"Seq: {seq} frame: {frame} Epoch: {self.current_epoch}", (5, 4)]
-
-            if self.dataset_name == 'trajnet_sdd':
-                bkg_img_path = os.path.join(f'datasets/trajnet_sdd/reference_img/{seq[:-2]}/video{seq[-1]}/reference.jpg')
-            else:
-                bkg_img_path = None
-            SADE_min_i = np.argmin(seq_to_sample_metrics['ADE'])
-            pred_fake_traj_min = pred_fake_traj[SADE_min_i]
-            min_SADE_stats = get_metrics_str(seq_to_sample_metrics, SADE_min_i)
-            args_dict = {'plot_title': f"best mSADE sample",
-                         'obs_traj': obs_traj,
-                         'pred_traj_gt': pred_gt_traj,
-                         'pred_traj_fake': pred_fake_traj_min,
-                         'collision_mats': collision_mats[frame_i][-1],
-                         'bkg_img_path': bkg_img_path,
-                         'text_fixed': min_SADE_stats}
-            plot_args_list.append(args_dict)
-
-            for sample_i in range(num_samples - 1):
-                stats = get_metrics_str(seq_to_sample_metrics, sample_i)
-                args_dict = {'plot_title': f"Sample {sample_i}",
-                             'obs_traj': obs_traj,
-                             'pred_traj_gt': pred_gt_traj,
-                             'pred_traj_fake': pred_fake_traj[sample_i],
-                             'text_fixed': stats,
-                             'bkg_img_path': bkg_img_path,
-                             'highlight_peds': argmins[frame_i],
-                             'collision_mats': collision_mats[frame_i][sample_i]}
-                plot_args_list.append(args_dict)
-            seq_to_plot_args.append(plot_args_list)
-
+        # best joint-ADE sample of every sequence, in one argmin over (seqs, samples)
+        SADE_min_is = np.argmin(np.stack([sample_vals['ADE'] for sample_vals in all_sample_vals]), axis=1)
+        # only ship what is plotted to the workers (not the model's data dict)
+        seq_viz_args = [{'frame': output['frame'], 'seq': output['seq'],
+                         'obs_traj': output['obs_motion'],
+                         'gt_traj': output['gt_motion'],
+                         'pred_traj': output['pred_motion'],
+                         'sample_vals': seq_to_sample_metrics,
+                         'argmins': argmins[frame_i],
+                         'SADE_min_i': SADE_min_is[frame_i],
+                         'collision_mats': collision_mats[frame_i]}
+                        for frame_i, (output, seq_to_sample_metrics) in enumerate(zip(outputs, all_sample_vals))]
+        plot_fn = partial(plot_seq, model_name=self.model_name, dataset_name=self.dataset_name,
+                          epoch=self.current_epoch, tag=tag)
+
+        # arg assembly, mkdir and rendering of each sequence all run in the workers, in whatever order they finish
         if self.args.mp:
-            with multiprocessing.Pool(self.num_workers) as pool:
-                pool.starmap(plot_anim_grid, seq_to_plot_args)
+            for _ in self._get_pool().imap_unordered(plot_fn, seq_viz_args, chunksize=1):
+                pass
         else:
-            list(starmap(plot_anim_grid, seq_to_plot_args))
+            list(map(plot_fn, seq_viz_args))
 
     def train_epoch_end(self, outputs):
         self._epoch_end(outputs, 'train')
@@ -1,10 +1,15 @@
 import numpy as np
 
+import matplotlib
+matplotlib.use('Agg')  # animations are only ever saved to file, so render offscreen
 import matplotlib.lines as mlines
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 from matplotlib.cm import ScalarMappable as sm
 import matplotlib.patches as patches
+from matplotlib.collections import EllipseCollection
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 
 
 def get_metrics_str(sample_vals, i=None):
@@ -20,12 +25,76 @@ def get_metrics_str(sample_vals, i=None):
 def get_max_bounds(trajs, padding=0.2):
     """from list of obs_traj, pred_traj
     of shape (obs_len, num_peds, 2) or (pred_len, **, num_peds, 2)"""
-    bounds = np.concatenate([np.array(traj).reshape(-1, 2) for traj in trajs])
-    bounds = [*(np.min(bounds, axis=0) - padding), *(np.max(bounds, axis=0) + padding)]
+    bounds_min, bounds_max = np.full(2, np.inf), np.full(2, -np.inf)
+    for traj in trajs:
+        # a list holds one array per model; take each one's extent rather than stacking them
+        for t in (traj if isinstance(traj, list) else [traj]):
+            t = np.asarray(t).reshape(-1, 2)
+            np.minimum(bounds_min, t.min(axis=0), out=bounds_min)
+            np.maximum(bounds_max, t.max(axis=0), out=bounds_max)
+    bounds = [*(bounds_min - padding), *(bounds_max + padding)]
     return bounds
 
 
-def plot_anim_grid(save_fn, title=None, plot_size=None, *list_of_arg_dicts):
+def save_anim(fig, update, num_frames, save_fn, interval=500, render_every=1):
+    """save an animation by drawing each frame exactly once.
+    FuncAnimation.save redraws the whole canvas before the writer draws it again to grab the frame
+    render_every: still step update through every frame, but only draw every render_every-th one (and the last);
+                  frames are shown render_every times as long, so the animation keeps its duration
+    without a save_fn there is nothing to write, so no frame is rendered"""
+    if save_fn is None:
+        return
+    writer_name = plt.rcParams['animation.writer']
+    if animation.writers.is_available(writer_name):
+        writer_cls = animation.writers[writer_name]
+    else:
+        writer_cls = animation.PillowWriter
+    dpi = plt.rcParams['savefig.dpi']
+    if dpi == 'figure':
+        dpi = fig.dpi
+    writer = writer_cls(fps=1000 / (interval * render_every))
+    with writer.saving(fig, save_fn, dpi):
+        for frame_i in range(num_frames):
+            update(frame_i)
+            if frame_i % render_every == 0 or frame_i == num_frames - 1:
+                writer.grab_frame()
+    print(f"saved animation to {save_fn}")
+
+
+def load_bkg_img(bkg_img_path):
+    """decode a background image once, as the semi-transparent RGBA array that plot_traj_anim draws"""
+    try:
+        img = plt.imread(bkg_img_path)
+    except FileNotFoundError:
+        return None
+    alpha = int(.5 * 255)
+    return np.dstack((img, alpha * np.ones_like(img[:, :, 0:1])))
+
+
+# (num_plots_height, num_plots_width) -> (fig, axes), reused by every plot_anim_grid call in this process
+_grid_figs = {}
+
+
+def get_grid_fig(num_plots_height, num_plots_width):
+    """figure and flat list of axes for a grid of subplots, with the axes emptied.
+    constructing (or cla()-ing) Axes is slow, so each grid size is only built once per process and
+    reused by removing the artists plot_traj_anim added; it re-sets the title, limits and aspect itself"""
+    if (num_plots_height, num_plots_width) not in _grid_figs:
+        fig = Figure(figsize=(7.5 * num_plots_width, 5 * num_plots_height))
+        FigureCanvasAgg(fig)
+        axes = list(fig.subplots(num_plots_height, num_plots_width, squeeze=False).flat)
+        _grid_figs[num_plots_height, num_plots_width] = fig, axes
+    fig, axes = _grid_figs[num_plots_height, num_plots_width]
+    for ax in axes:
+        for artist in [*ax.lines, *ax.patches, *ax.texts, *ax.images, *ax.collections, *ax.artists]:
+            artist.remove()
+        if ax.get_legend() is not None:
+            ax.get_legend().remove()
+    fig.set_layout_engine('constrained')
+    return fig, axes
+
+
+def plot_anim_grid(save_fn, title=None, plot_size=None, *list_of_arg_dicts, render_every=1):
     if plot_size is None:
         if len(list_of_arg_dicts) > 4:
             num_plots_height = 2
@@ -38,36 +107,36 @@ def plot_anim_grid(save_fn, title=None, plot_size=None, *list_of_arg_dicts):
 
     assert num_plots_width * num_plots_height >= len(list_of_arg_dicts), \
         f'plot_size ({plot_size}) must be able to accomodate {len(list_of_arg_dicts)} graphs'
-    fig, axes = plt.subplots(num_plots_height, num_plots_width, figsize=(7.5 * num_plots_width, 5 * num_plots_height))
-    if isinstance(axes[0], np.ndarray):
-        axes = [a for ax in axes for a in ax]
+    fig, axes = get_grid_fig(num_plots_height, num_plots_width)
     anim_graphs = []
 
     obs_len = 8
     pred_len = 12
 
-    bounds = []
-    for graph in list_of_arg_dicts:
-        for key, val in graph.items():
-            if 'traj' in key:
-                bounds.append(np.array(val).reshape(-1, 2))
-    bounds = np.concatenate(bounds)
-    bounds = [*(np.min(bounds, axis=0) - 0.2), *(np.max(bounds, axis=0) + 0.2)]
+    bounds = get_max_bounds([val for graph in list_of_arg_dicts for key, val in graph.items() if 'traj' in key])
+
+    # every subplot usually shares one background: decode each image once, not once per subplot
+    bkg_img_paths = {arg_dict.get('bkg_img_path') for arg_dict in list_of_arg_dicts} - {None}
+    bkg_imgs = {bkg_img_path: load_bkg_img(bkg_img_path) for bkg_img_path in bkg_img_paths}
 
     for ax_i, (arg_dict, ax) in enumerate(zip(list_of_arg_dicts, axes)):
         ao = AnimObj()
         anim_graphs.append(ao)
-        ao.plot_traj_anim(**arg_dict, ax=ax, bounds=bounds)
-
-    anim = animation.FuncAnimation(fig, lambda frame_i: [ag.update(frame_i) for ag in anim_graphs],
-                                   frames=obs_len + pred_len, interval=500)
-    fig.tight_layout()
-    fig.subplots_adjust(hspace=0.2)
-    if title is not None:
-        fig.suptitle(title, fontsize=16)
-    anim.save(save_fn)
-    print(f"saved animation to {save_fn}")
-    plt.close(fig)
+        ao.plot_traj_anim(**arg_dict, ax=ax, bounds=bounds, bkg_img=bkg_imgs.get(arg_dict.get('bkg_img_path')))
+    for ax in axes[len(list_of_arg_dicts):]:  # spare subplots may keep the limits of an earlier grid
+        ax.cla()
+
+    def mass_update(frame_i):
+        for ag in anim_graphs:
+            ag.update(frame_i)
+
+    # the figure may be reused, so always (re)set the title, and leave no room for it when there is none
+    suptitle = fig.suptitle('' if title is None else title, fontsize=16)
+    suptitle.set_in_layout(title is not None)
+    # the axes never move between frames: solve the layout once, then stop re-solving it on every draw
+    fig.draw_without_rendering()
+    fig.set_layout_engine('none')
+    save_anim(fig, mass_update, obs_len + pred_len, save_fn, render_every=render_every)
 
 
 def plot_traj_anim(**kwargs):
@@ -80,7 +149,7 @@ class AnimObj:
         self.update = None
 
     def plot_traj_anim(self, obs_traj=None, save_fn=None, ped_radius=0.1, ped_discomfort_dist=0.2, pred_traj_gt=None,
-                       pred_traj_fake=None, ped_num_label_on='gt', show_ped_pos=False, bkg_img_path=None,
+                       pred_traj_fake=None, ped_num_label_on='gt', show_ped_pos=False, bkg_img_path=None, bkg_img=None,
                        bounds=None, int_cat_abbv=None, scene_stats=None, cfg_names=None,
                        collision_mats=None, cmap_name='tab10', extend_last_frame=3, show_ped_stats=False,
                        text_time=None, text_fixed=None, grid_values=None, plot_collisions_all=False, plot_title=None,
@@ -95,6 +164,7 @@ class AnimObj:
                         or list of tensors of shape (8 or 12, num_peds, 2)  (where each item are the samples predicted by a different model)
                         or list of tensors of shape (num_samples, 8 or 12 pred timesteps, num_peds, 2)
         show_ped_pos: whether to show the position of each ped next to the ped circle
+        bkg_img: already-decoded background (from load_bkg_img); if None, bkg_img_path is read instead
         bounds: x_low, y_low, x_high, y_high: plotting bounds
                 if not specified the min and max bounds of whichever trajectories are present are used
         pred_traj_gt: shape (8 or 12, num_peds, 2) ground-truth trajectory
@@ -129,14 +199,10 @@ class AnimObj:
         ax.set_aspect("equal")
 
         # plot background image for SDD
-        if bkg_img_path is not None:
-            try:
-                img = imageio.imread(bkg_img_path)
-                alpha = int(.5 * 255)
-                img = np.dstack((img, alpha * np.ones_like(img[:, :, 0:1])))
-                ax.imshow(img)
-            except FileNotFoundError:
-                pass
+        if bkg_img is None and bkg_img_path is not None:
+            bkg_img = load_bkg_img(bkg_img_path)
+        if bkg_img is not None:
+            ax.imshow(bkg_img)
 
         # make pred_traj_fake standard shape of (num_samples, num_timesteps, num_peds, 2)
         if pred_traj_fake is not None:
@@ -155,6 +221,15 @@ class AnimObj:
             assert isinstance(pred_traj_fake, list) and isinstance(pred_traj_fake[0], np.ndarray)
             assert len(pred_traj_fake[0].shape) == 4
 
+        # matplotlib converts every point it is given to C-contiguous float64; the model's float32 (and transposed)
+        # trajectories would otherwise be converted again on every set_data / set_offsets of every frame
+        if obs_traj is not None:
+            obs_traj = np.ascontiguousarray(obs_traj, dtype=np.float64)
+        if pred_traj_gt is not None:
+            pred_traj_gt = np.ascontiguousarray(pred_traj_gt, dtype=np.float64)
+        if pred_traj_fake is not None:
+            pred_traj_fake = [np.ascontiguousarray(ptf, dtype=np.float64) for ptf in pred_traj_fake]
+
         # obs len
         if obs_traj is not None:
             obs_len = obs_traj.shape[0]
@@ -179,15 +254,10 @@ class AnimObj:
 
         # calculate bounds automatically
         if bounds is None:
-            all_traj = np.zeros((0, 2))
-            if obs_traj is not None:
-                all_traj = obs_traj.reshape(-1, 2)
-            if pred_traj_gt is not None:
-                all_traj = np.concatenate([all_traj, pred_traj_gt.reshape(-1, 2)])
+            all_traj = [traj for traj in (obs_traj, pred_traj_gt) if traj is not None]
             if pred_traj_fake is not None:
-                all_traj = np.concatenate([all_traj, *[p.reshape(-1, 2) for ptf in pred_traj_fake for p in ptf]])
-            x_low, x_high = np.min(all_traj[:, 0]) - ped_radius, np.max(all_traj[:, 0]) + ped_radius
-            y_low, y_high = np.min(all_traj[:, 1]) - ped_radius, np.max(all_traj[:, 1]) + ped_radius
+                all_traj.append(pred_traj_fake)
+            x_low, y_low, x_high, y_high = get_max_bounds(all_traj, padding=ped_radius)
         else:  # set bounds as specified
             x_low, y_low, x_high, y_high = bounds
         ax.set_xlim(x_low, x_high)
@@ -203,6 +273,7 @@ class AnimObj:
         # each sample a different marker
         markers_0 = [None] * 10#['o', '*', '^', 's', '1', 'P', 'x', '$\#$', ',', '$\clubsuit$'] #'v', '<', ',', ]
         markers_1 = [None] * 10#['P', 'x', '$\#$', ',', '$\clubsuit$'] #'v', '<', ',', ]
+        markers = [markers_0, markers_1]  # indexed by model_i
         # each ped a different color
         cmap_real = plt.get_cmap(cmap_name, max(10, num_peds))
         cmap_fake = plt.get_cmap(cmap_name, max(10, num_peds))
@@ -248,45 +319,48 @@ class AnimObj:
                 raise NotImplementedError("text_fixed is unrecognized format")
 
         # ped graph elements
-        # circles_fake: [ped_i, model_i, sample_i]
-        circles_gt, circles_fake, last_obs_circles, lines_pred_gt, lines_obs_gt, lines_pred_fake = [], [], [], [], [], []
+        # lines_pred_fake, colors_fake: flat, with the (model_i, sample_i, ped_i) of each entry in fake_ids
+        fake_ids, colors_fake = [], []
+        circles_gt, last_obs_circles, lines_pred_gt, lines_obs_gt, lines_pred_fake = [], [], [], [], []
 
         # plot circles to represent peds
         legend_lines = []
         legend_labels = []
 
+        # gt peds are drawn as one collection of circles for the obs steps and one of smaller, faded circles
+        # for the pred steps; both follow gt_centers
+        gt_centers = obs_traj[0] if obs_traj is not None else pred_traj_gt[0] if pred_traj_gt is not None else None
+        if gt_centers is not None:
+            colors_real = [cmap_real(ped_i % num_peds) for ped_i in range(num_peds)]
+            for radius, alpha, visible in [(ped_radius, None, True), (ped_radius * 0.5, 0.3, False)]:
+                circles_gt.append(ax.add_collection(EllipseCollection(
+                        np.full(num_peds, 2 * radius), np.full(num_peds, 2 * radius), np.zeros(num_peds), units='xy',
+                        offsets=gt_centers, offset_transform=ax.transData, facecolors=colors_real, edgecolors=colors_real,
+                        alpha=alpha, zorder=0, visible=visible), autolim=False))
+
         for ped_i in range(num_peds):
             color_real = cmap_real(ped_i % num_peds)
             color_fake = cmap_fake(ped_i % num_peds)
 
             # plot ground-truth obs and pred
             if obs_traj is not None:
-                circles_gt.append(ax.add_artist(plt.Circle(obs_traj[0, ped_i], ped_radius, fill=True, color=color_real, zorder=0)))
                 line_obs_gt = mlines.Line2D(*obs_traj[0:1].T, color=color_real, marker='.', linestyle='-', linewidth=1,
                                             alpha=obs_alpha, zorder=0)
                 lines_obs_gt.append(ax.add_artist(line_obs_gt))
 
             if pred_traj_gt is not None:
-                if obs_traj is None:
-                    circles_gt.append(ax.add_artist(plt.Circle(pred_traj_gt[0, ped_i], ped_radius, fill=True, color=color_real, zorder=0)))
                 line_pred_gt = mlines.Line2D(*pred_traj_gt[0:1].T, color=color_real, marker='.', linestyle='dotted', linewidth=1,
                                              alpha=pred_alpha, zorder=0, visible=False)
                 lines_pred_gt.append(ax.add_artist(line_pred_gt))
 
             if pred_traj_fake is not None:  # plot fake pred trajs
-                lpf, cf = [], []
                 for model_i, ptf in enumerate(pred_traj_fake):
-                    lpf_inner, cf_inner = [], []
                     color = color_fake
                     # color = color_fake[ped_i % len(color_fake)][model_i]
                     for sample_i, p in enumerate(ptf):
-                        circle_fake = plt.Circle(p[0, ped_i], ped_radius, fill=True,
-                                                 color=color,
-                                                 alpha=obs_alpha, visible=False, zorder=1)
-                        cf_inner.append(ax.add_artist(circle_fake))
                         if cfg_names is not None:
                             label = f"{cfg_names[model_i]} ped {ped_i}" if sample_i == 0 else None
-                        marker = locals()[f'markers_{model_i}'][sample_i]
+                        marker = markers[model_i][sample_i]
                         line_pred_fake = mlines.Line2D(*p[0:1].T, color=color,
                                                        marker=marker,
                                                        linestyle='--',
@@ -297,11 +371,18 @@ class AnimObj:
                             legend_labels.append(label)
                             legend_lines.append(patches.Patch(color=color, linestyle=linestyles[model_i], label=label))
 
-                        lpf_inner.append(ax.add_artist(line_pred_fake))
-                    cf.append(cf_inner)
-                    lpf.append(lpf_inner)
-                lines_pred_fake.append(lpf)
-                circles_fake.append(cf)
+                        lines_pred_fake.append(ax.add_artist(line_pred_fake))
+                        fake_ids.append((model_i, sample_i, ped_i))
+                        colors_fake.append(color)
+
+        # fake peds, in fake_ids order: positions over the pred steps as one contiguous (pred_len, num_fake, 2) array,
+        # so each frame moves the whole collection of fake circles with one slab
+        if pred_traj_fake is not None:
+            traj_fake = np.stack([pred_traj_fake[model_i][sample_i, :, ped_i] for model_i, sample_i, ped_i in fake_ids], axis=1)
+            circles_fake = ax.add_collection(EllipseCollection(
+                    np.full(len(fake_ids), 2 * ped_radius), np.full(len(fake_ids), 2 * ped_radius), np.zeros(len(fake_ids)),
+                    units='xy', offsets=traj_fake[0], offset_transform=ax.transData, facecolors=colors_fake,
+                    edgecolors=colors_fake, alpha=obs_alpha, zorder=1, visible=False), autolim=False)
 
         ax.legend(handles=legend_lines, loc='upper right')
         # ax.legend(legend_lines, legend_labels, loc='upper right')
@@ -311,34 +392,42 @@ class AnimObj:
         # add interaction category annotations, if specified
         ped_texts = []
         if ped_num_label_on == 'gt':
-            circles_to_plot_ped_num = circles_gt
+            centers_to_plot_ped_num = gt_centers if gt_centers is not None else []
         elif ped_num_label_on == 'pred' or obs_traj is None and pred_traj_gt is None:
-            circles_to_plot_ped_num = circles_fake
+            assert pred_traj_fake is not None, "ped_num_label_on is 'pred', so pred_traj_fake must be given"
+            centers_to_plot_ped_num = [center for center, ids in zip(traj_fake[0], fake_ids) if ids[:2] == (0, 0)]
         else:
             raise RuntimeError
-        for ped_i, circle in enumerate(circles_to_plot_ped_num):
+        for ped_i, center in enumerate(centers_to_plot_ped_num):
             weight = 'bold' if ped_i in highlight_peds else None
-            int_text = ax.text(circle.center[0] + text_offset_x, circle.center[1] - text_offset_y,
+            int_text = ax.text(center[0] + text_offset_x, center[1] - text_offset_y,
                                str(ped_i), color='black', fontsize=8, weight=weight)
             ped_texts.append(ax.add_artist(int_text))
 
         if show_ped_pos:
             ped_pos_texts_obs = []
-            for ped_i, circle in enumerate(circles_gt):
-                ped_pos_text = f"{circle.center[0]:0.1f}, {circle.center[1]:0.1f}"
-                ped_pos_texts_obs.append(ax.add_artist(ax.text(circle.center[0] + text_offset_x, circle.center[1] + text_offset_y,
+            for center in gt_centers if gt_centers is not None else []:
+                ped_pos_text = f"{center[0]:0.1f}, {center[1]:0.1f}"
+                ped_pos_texts_obs.append(ax.add_artist(ax.text(center[0] + text_offset_x, center[1] + text_offset_y,
                                                                ped_pos_text, fontsize=8,)))
-            ped_pos_texts = []
-            for ped_i, circle_3 in enumerate(circles_fake):
-                ppt = []
-                for model_i, circle_2 in enumerate(circle_3):
-                    ppt_i = []
-                    for sample_i, circle in enumerate(circle_2):
-                        ped_pos_text = f"{circle.center[0]:0.1f}, {circle.center[1]:0.1f}"
-                        ppt_i.append(ax.add_artist(ax.text(circle.center[0] + text_offset_x, circle.center[1] + text_offset_y,
+            ped_pos_texts = []  # in fake_ids order
+            for center in traj_fake[0] if pred_traj_fake is not None else []:
+                ped_pos_text = f"{center[0]:0.1f}, {center[1]:0.1f}"
+                ped_pos_texts.append(ax.add_artist(ax.text(center[0] + text_offset_x, center[1] + text_offset_y,
                                                            ped_pos_text, fontsize=8, visible=False)))
-                    ppt.append(ppt_i)
-                ped_pos_texts.append(ppt)
+
+        # heatmap
+        if grid_values is not None:
+            x, y = np.meshgrid(np.linspace(*bounds[:2], grid_values.shape[1] + 1),
+                               np.linspace(*bounds[2:4], grid_values.shape[2] + 1))
+            # z = grid_values[0].reshape(x.shape[0] - 1, x.shape[1] - 1)
+            z = grid_values[0]
+
+            z_min, z_max = np.min(np.array(z)), np.max(np.array(z))
+            # normalize every frame (by the first frame's range) in one op, up front
+            normed_grid = ((np.asarray(grid_values) - z_min) / (z_max - z_min)).reshape(len(grid_values), x.shape[0] - 1, x.shape[1] - 1)
+            # one mesh for the whole animation; update() only swaps in each frame's values
+            state_mesh = ax.pcolormesh(x, y, normed_grid[0], alpha=.1, vmin=0, vmax=1, zorder=1)
 
         # plot collision circles for predictions only
         if collision_mats is not None:
@@ -349,21 +438,78 @@ class AnimObj:
             collision_texts = [ax.add_artist(ax.text(0, 0, "", visible=False, fontsize=8)) for _ in range(num_peds)]
             collision_delay = 3
             yellow = (.8, .8, 0, .2)
-            collided_delays = np.zeros(num_peds)
 
-        # heatmap
-        if grid_values is not None:
-            x, y = np.meshgrid(np.linspace(*bounds[:2], grid_values.shape[1] + 1),
-                               np.linspace(*bounds[2:4], grid_values.shape[2] + 1))
-            # z = grid_values[0].reshape(x.shape[0] - 1, x.shape[1] - 1)
-            z = grid_values[0]
+            assert len(collision_mats.shape) == 3 and collision_mats.shape[1] == collision_mats.shape[2], 'collision mats is not square'
+            if plot_collisions_all:
+                assert len(collision_mats) == obs_len + pred_len, f'plot_collisons_all is {plot_collisions_all}, so collision_mat size should be {obs_len + pred_len} but is {len(collision_mats)}'
+            else:
+                assert len(collision_mats) == pred_len, f'plot_collisons_all is {plot_collisions_all}, so collision_mat size should be {pred_len} but is {len(collision_mats)}'
+            # positions of the peds the collisions are between, over the whole scene
+            if pred_traj_fake is not None and obs_traj is not None:
+                assert len(pred_traj_fake) == 1, "if plotting collision circles, should only plot one model"
+                assert pred_traj_fake[0].shape[0] == 1, "if plotting collision circles, should only plot one sample"
+                obs_gt_fake = np.concatenate([obs_traj, pred_traj_fake[0][0]])
+            elif pred_traj_gt is not None and obs_traj is not None:
+                obs_gt_fake = np.concatenate([obs_traj, pred_traj_gt])
+            elif pred_traj_fake is not None:
+                obs_gt_fake = pred_traj_fake[0][0]
+            elif pred_traj_gt is not None:
+                obs_gt_fake = pred_traj_gt
+            else:
+                raise RuntimeError
 
-            z_min, z_max = np.min(np.array(z)), np.max(np.array(z))
-            state_mesh = ax.pcolormesh(x, y, z, alpha=.8, vmin=0, vmax=1, zorder=3)
+            # the circles only depend on collision_mats and positions, so work out up front, for each frame, which peds
+            # start a collision circle (and where), and which drop theirs
+            collision_schedule = {}
+            collided_delays = np.zeros(num_peds)
+            for frame_i in range(0 if plot_collisions_all else obs_len, obs_len + pred_len):
+                if plot_collisions_all:
+                    collision_frame_idx = frame_i
+                else:
+                    collision_frame_idx = frame_i - obs_len
+                # new frame; decrease the text disappearance delay by 1
+                collided_delays[collided_delays > 0] -= 1
+                # each ped is checked against the peds before it; while still in delay, its circle doesn't disappear
+                collision_mat = np.tril(collision_mats[collision_frame_idx], k=-1)
+                collided = collision_mat.any(axis=1)
+                in_delay = collided_delays > 0
+                starts = np.flatnonzero(collided & ~in_delay)
+                ## put the center of the circle in the point between each ped and the first earlier ped it collides with
+                centers = (obs_gt_fake[frame_i][starts] + obs_gt_fake[frame_i][collision_mat[starts].argmax(axis=1)]) / 2
+                collision_schedule[frame_i] = starts, centers, np.flatnonzero(~collided & ~in_delay)
+                collided_delays[starts] = collision_delay
+
+            # the persistent yellow collision circles, all known now: one collection, in the order they appear, kept
+            # fully transparent until update() reaches the frame of each
+            yellow_centers = np.concatenate([np.zeros((0, 2)), *[centers for _, centers, _ in collision_schedule.values()]])
+            yellow_colors = np.zeros((len(yellow_centers), 4))
+            num_yellow_shown = dict(zip(collision_schedule, np.cumsum([len(starts) for starts, _, _ in collision_schedule.values()])))
+            yellow_circles = ax.add_collection(EllipseCollection(
+                    np.full(len(yellow_centers), 2 * collide_circle_rad), np.full(len(yellow_centers), 2 * collide_circle_rad),
+                    np.zeros(len(yellow_centers)), units='xy', offsets=yellow_centers, offset_transform=ax.transData,
+                    facecolors=yellow_colors, edgecolors='none', zorder=1), autolim=False)
+
+        # lines of the pred steps start at the last obs step: build each full path once, not every frame
+        if pred_traj_gt is not None:
+            path_gt = pred_traj_gt if obs_traj is None else np.concatenate([obs_traj[-1:], pred_traj_gt])
+        if pred_traj_fake is not None:
+            fake_ped_ids = [ped_i for _, _, ped_i in fake_ids]
+            paths_fake = traj_fake if obs_traj is None else np.concatenate([obs_traj[-1:, fake_ped_ids], traj_fake])
+
+        # ped number / position labels sit at a fixed offset from their ped: place them (and format the positions)
+        # for every frame at once, as plain floats and strings the per-frame setters take directly
+        label_offset = np.array([text_offset_x, -text_offset_y])
+        labels_obs = (obs_traj + label_offset).tolist() if obs_traj is not None else None
+        labels_gt = (pred_traj_gt + label_offset).tolist() if pred_traj_gt is not None else None
+        labels_fake = (traj_fake + label_offset).tolist() if pred_traj_fake is not None else None
+        if show_ped_pos:
+            def pos_strs(traj):
+                return [[f"{x:0.1f}, {y:0.1f}" for x, y in frame] for frame in traj.tolist()]
+            pos_strs_obs = pos_strs(obs_traj) if obs_traj is not None else None
+            pos_strs_fake = pos_strs(traj_fake) if pred_traj_fake is not None else None
 
         ## animation update function
         def update(frame_i):
-            nonlocal x, y
             # for replicating last scene
             if frame_i >= obs_len + pred_len:
                 return
@@ -376,49 +522,42 @@ class AnimObj:
 
             # heatmap
             if grid_values is not None and frame_i < obs_len + pred_len - 1:
-                nonlocal state_mesh, x, y
-                z = grid_values[frame_i]
-                normed_z = ((z - z_min) / (z_max - z_min)).reshape(x.shape[0] - 1, x.shape[1] - 1)
-                state_mesh.remove()
-                state_mesh = ax.pcolormesh(x, y, normed_z, alpha=.1, vmin=0, vmax=1, zorder=1)
+                state_mesh.set_array(normed_grid[frame_i])
 
             # move the real and pred (fake) agent
             if frame_i < obs_len:
-                for ped_i, (circle_gt, line_obs_gt) in enumerate(zip(circles_gt, lines_obs_gt)):
-                    circle_gt.center = obs_traj[frame_i, ped_i]
+                for circles in circles_gt:
+                    circles.set_offsets(obs_traj[frame_i])
+                for ped_i, line_obs_gt in enumerate(lines_obs_gt):
                     line_obs_gt.set_data(*obs_traj[0:frame_i + 1, ped_i].T)
-                    if show_ped_pos and len(ped_pos_texts_obs) > 0:
-                        ped_pos_text = f"{circle_gt.center[0]:0.1f}, {circle_gt.center[1]:0.1f}"
-                        ped_pos_texts_obs[ped_i].set_text(ped_pos_text)
-                        ped_pos_texts_obs[ped_i].set_position((circle_gt.center[0] + text_offset_x, circle_gt.center[1] - text_offset_y))
-                for ped_i, circle_fake in enumerate(circles_fake):
-                    circle_fake[0][0].center = obs_traj[frame_i, ped_i]
                 if show_ped_pos:
+                    for text, ped_pos_text, label_pos in zip(ped_pos_texts_obs, pos_strs_obs[frame_i], labels_obs[frame_i]):
+                        text.set_text(ped_pos_text)
+                        text.set_position(label_pos)
                     [text.set_visible(True) for text in ped_pos_texts_obs]
-                    [text.set_visible(False) for cf in ped_pos_texts for cf_inner in cf for text in cf_inner]
+                    [text.set_visible(False) for text in ped_pos_texts]
 
                 # move the pedestrian texts (ped number and relation)
-                for ped_text, circle in zip(ped_texts, circles_gt):  # circles_to_plot_ped_num):
-                    ped_text.set_position((circle.center[0] + text_offset_x, circle.center[1] - text_offset_y))
+                for ped_text, label_pos in zip(ped_texts, labels_obs[frame_i]):
+                    ped_text.set_position(label_pos)
 
             elif frame_i == obs_len:
-                [circle_fake.set_visible(True) for cf in circles_fake for cf_inner in cf for circle_fake in cf_inner]
+                if pred_traj_fake is not None:
+                    circles_fake.set_visible(True)
                 if show_ped_pos:
-                    [text.set_visible(True) for cf in ped_pos_texts for cf_inner in cf for text in cf_inner]
+                    [text.set_visible(True) for text in ped_pos_texts]
                     [text.set_visible(False) for text in ped_pos_texts_obs]
-                for circle_gt in circles_gt:
-                    circle_gt.set_radius(ped_radius * 0.5)
-                    circle_gt.set_alpha(0.3)
+                if len(circles_gt) > 0:  # switch to the smaller, faded pred-step circles
+                    circles_gt[0].set_visible(False)
+                    circles_gt[1].set_visible(True)
                 for line_obs_gt in lines_obs_gt:
                     line_obs_gt.set_alpha(0.2)
                 if pred_traj_gt is not None:
                     for line_pred_gt in lines_pred_gt:
                         line_pred_gt.set_visible(True)
                 if pred_traj_fake is not None:
-                    for lpf in lines_pred_fake:
-                        for lpf_inner in lpf:
-                            for line_pred_fake in lpf_inner:
-                                line_pred_fake.set_visible(True)
+                    for line_pred_fake in lines_pred_fake:
+                        line_pred_fake.set_visible(True)
 
                 for last_obs_circ in last_obs_circles:
                     last_obs_circ.set_radius(ped_radius * 0.75)
@@ -428,90 +567,48 @@ class AnimObj:
             if obs_len <= frame_i < obs_len + pred_len:
                 # if frame_i == 12 or frame_i == 11:
                 #     import ipdb; ipdb.set_trace()
+                # number of path points drawn so far, counting the last obs step the paths start from
+                path_len = frame_i + 1 - obs_len + (obs_traj is not None)
                 if pred_traj_gt is not None:
-                    # traj_gt = np.concatenate([obs_traj, pred_traj_gt])
-                    assert len(circles_gt) == len(lines_pred_gt) == len(ped_texts), f'{len(circles_gt)}, {len(lines_pred_gt)}, {len(ped_texts)} should all be equal'
-                    for ped_i, (circle_gt, line_pred_gt) in enumerate(zip(circles_gt, lines_pred_gt)):
-                        circle_gt.center = pred_traj_gt[frame_i - obs_len, ped_i]
-                        if obs_traj is not None:
-                            last_obs_pred_gt = np.concatenate([obs_traj[-1:, ped_i], pred_traj_gt[0:frame_i + 1 - obs_len, ped_i]])
-                        else:
-                            last_obs_pred_gt = pred_traj_gt[0:frame_i + 1 - obs_len, ped_i]
-                        line_pred_gt.set_data(*last_obs_pred_gt.T)
-                        # move the pedestrian texts (ped number and relation)
-                        if len(ped_texts) > 0:
-                            ped_texts[ped_i].set_position((circle_gt.center[0] + text_offset_x, circle_gt.center[1] - text_offset_y))
+                    assert len(lines_pred_gt) == len(ped_texts), f'{len(lines_pred_gt)}, {len(ped_texts)} should be equal'
+                    for circles in circles_gt:
+                        circles.set_offsets(pred_traj_gt[frame_i - obs_len])
+                    for ped_i, line_pred_gt in enumerate(lines_pred_gt):
+                        line_pred_gt.set_data(*path_gt[:path_len, ped_i].T)
+                    # move the pedestrian texts (ped number and relation)
+                    for ped_text, label_pos in zip(ped_texts, labels_gt[frame_i - obs_len]):
+                        ped_text.set_position(label_pos)
 
                 if pred_traj_fake is not None:
-                    assert len(lines_pred_fake) == len(circles_fake)
-                    for ped_i, (cf, lpf) in enumerate(zip(circles_fake, lines_pred_fake)):
-                        assert len(cf) == len(lpf)
-                        for model_i, (cf_inner, lpf_inner) in enumerate(zip(cf, lpf)):
-                            assert len(cf_inner) == len(lpf_inner)
-                            for sample_i, (circle_fake, line_pred_fake) in enumerate(zip(cf_inner, lpf_inner)):
-                                circle_fake.center = pred_traj_fake[model_i][sample_i, frame_i - obs_len, ped_i]
-                                if obs_traj is not None:
-                                    last_obs_pred_fake = np.concatenate([obs_traj[-1:, ped_i], pred_traj_fake[model_i][sample_i, 0:frame_i + 1 - obs_len, ped_i]])
-                                else:
-                                    last_obs_pred_fake = pred_traj_fake[model_i][sample_i, 0:frame_i + 1 - obs_len, ped_i]
-                                line_pred_fake.set_data(*last_obs_pred_fake.T)
-                                if show_ped_pos and len(ped_pos_texts) > 0:
-                                    ped_pos_text = f"{circle_fake.center[0]:0.1f}, {circle_fake.center[1]:0.1f}"
-                                    ped_pos_texts[ped_i][model_i][sample_i].set_text(ped_pos_text)
-                                    ped_pos_texts[ped_i][model_i][sample_i].set_position((circle_fake.center[0] + text_offset_x, circle_fake.center[1] - text_offset_y))
+                    assert len(lines_pred_fake) == len(fake_ids)
+                    circles_fake.set_offsets(traj_fake[frame_i - obs_len])
+                    for fake_i, line_pred_fake in enumerate(lines_pred_fake):
+                        line_pred_fake.set_data(*paths_fake[:path_len, fake_i].T)
+                    if show_ped_pos:
+                        for text, ped_pos_text, label_pos in zip(ped_pos_texts, pos_strs_fake[frame_i - obs_len],
+                                                                 labels_fake[frame_i - obs_len]):
+                            text.set_text(ped_pos_text)
+                            text.set_position(label_pos)
 
             # update collision circles (only if we are during pred timesteps)
-            if (plot_collisions_all or obs_len <= frame_i <= obs_len + pred_len) and collision_mats is not None:
-                assert len(collision_mats.shape) == 3 and collision_mats.shape[1] == collision_mats.shape[2], 'collision mats is not square'
-                if plot_collisions_all:
-                    assert len(collision_mats) == obs_len + pred_len, f'plot_collisons_all is {plot_collisions_all}, so collision_mat size should be {obs_len + pred_len} but is {len(collision_mats)}'
-                else:
-                    assert len(collision_mats) == pred_len, f'plot_collisons_all is {plot_collisions_all}, so collision_mat size should be {pred_len} but is {len(collision_mats)}'
-
-                if pred_traj_fake is not None and obs_traj is not None:
-                    assert len(pred_traj_fake) == 1, "if plotting collision circles, should only plot one model"
-                    assert pred_traj_fake[0].shape[0] == 1, "if plotting collision circles, should only plot one sample"
-                    obs_gt_fake = np.concatenate([obs_traj, pred_traj_fake[0][0]])
-                elif pred_traj_gt is not None and obs_traj is not None:
-                    obs_gt_fake = np.concatenate([obs_traj, pred_traj_gt])
-                elif pred_traj_fake is not None:
-                    obs_gt_fake = pred_traj_fake[0][0]
-                elif pred_traj_gt is not None:
-                    obs_gt_fake = pred_traj_gt
-                else:
-                    raise RuntimeError
-
-                for ped_i in range(num_peds):
-                    # new frame; decrease the text disappearance delay by 1
-                    if collided_delays[ped_i] > 0:
-                        collided_delays[ped_i] -= 1
-                    for ped_j in range(ped_i):
-                        if plot_collisions_all:
-                            collision_frame_idx = frame_i
-                        else:
-                            collision_frame_idx = frame_i - obs_len
-                        if collided_delays[ped_i] > 0:  # still in delay, circle doesn't disappear
-                            break
-                        elif collision_mats[collision_frame_idx, ped_i, ped_j]:
-                            ## put the center of the circle in the point between the two ped centers
-                            x = (obs_gt_fake[frame_i][ped_i][0] + obs_gt_fake[frame_i][ped_j][0]) / 2
-                            y = (obs_gt_fake[frame_i][ped_i][1] + obs_gt_fake[frame_i][ped_j][1]) / 2
-                            collision_circles[ped_i].set_center((x, y))
-                            collision_circles[ped_i].set_edgecolor(cmap_fake(ped_i))
-                            collision_circles[ped_i].set_visible(True)
-
-                            ## add persistent yellow collision circle
-                            ax.add_artist(plt.Circle((x, y), collide_circle_rad, fc=yellow, zorder=1, ec='none'))
-                            collided_delays[ped_i] = collision_delay
-                            break
-                        collision_circles[ped_i].set_visible(False)
-                        collision_texts[ped_i].set_visible(False)
+            if collision_mats is not None and frame_i in collision_schedule:
+                collision_starts, collision_centers, collision_ends = collision_schedule[frame_i]
+                for ped_i, center in zip(collision_starts, collision_centers):
+                    collision_circles[ped_i].set_center(tuple(center))
+                    collision_circles[ped_i].set_edgecolor(cmap_fake(ped_i))
+                    collision_circles[ped_i].set_visible(True)
+
+                ## show this frame's persistent yellow collision circles
+                if len(collision_starts) > 0:
+                    yellow_colors[:num_yellow_shown[frame_i]] = yellow
+                    yellow_circles.set_facecolor(yellow_colors)
+                for ped_i in collision_ends:
+                    collision_circles[ped_i].set_visible(False)
+                    collision_texts[ped_i].set_visible(False)
 
         self.update = update
 
         if fig is not None:
-            anim = animation.FuncAnimation(fig, update, frames=obs_len + pred_len + extend_last_frame, interval=500)
-            anim.save(save_fn)
-            print(f"saved animation to {save_fn}")
+            save_anim(fig, update, obs_len + pred_len + extend_last_frame, save_fn)
             plt.close(fig)
 